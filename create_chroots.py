@@ -1,78 +1,120 @@
 import argparse
+import concurrent.futures
 import copy
+import functools
+import hashlib
 import logging
 import os
 import subprocess
 import shutil
+import tempfile
+import threading
 import time
 
 import jinja2
 
-ENV = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'))
+ENV_OPTIONS = {
+    'trim_blocks': True,
+    'lstrip_blocks': True,
+    'autoescape': False,
+    'auto_reload': False,
+    'cache_size': -1,
+}
 
+# Jinja2 keys cached bytecode on the template source alone, so bytecode
+# compiled under different options must live in a different directory.
+BYTECODE_CACHE_DIR = os.path.join(
+    '.jinja_cache',
+    hashlib.sha1(repr(sorted(ENV_OPTIONS.items())).encode()).hexdigest())
+os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
 
-class Nameserver(object):
-    def __init__(self, name, ip, use_chroot):
+ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader('templates'),
+    bytecode_cache=jinja2.FileSystemBytecodeCache(BYTECODE_CACHE_DIR),
+    **ENV_OPTIONS)
+
+NAMED9_TMPL = ENV.get_template('named9.conf')
+ZONE_TMPL = ENV.get_template('zone_template')
+ROOT_ZONE_TMPL = ENV.get_template('root_zone_template')
+DB_CACHE_TMPL = ENV.get_template('db.cache')
+NSUPDATE_TMPL = ENV.get_template('nsupdate')
+
+MAX_WORKERS = 16
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+class Nameserver:
+    __slots__ = ('name', 'ip', 'use_chroot', 'chroot_dir')
+
+    def __init__(self, name, ip, use_chroot, chroots_dir):
         self.name = name
         self.ip = ip
         self.use_chroot = use_chroot
+        self.chroot_dir = os.path.join(chroots_dir, name)
 
     def build_dirs(self):
-        os.makedirs(os.path.join('chroots', self.name))
-        os.makedirs(os.path.join('chroots', self.name, 'var/named/zones'))
-        os.makedirs(os.path.join('chroots', self.name, 'var/log'))
+        os.makedirs(os.path.join(self.chroot_dir, 'var/named/zones'))
+        os.makedirs(os.path.join(self.chroot_dir, 'var/log'))
 
     def render_named9_conf(self):
-        named9_conf_template = ENV.get_template('named9.conf')
-        return named9_conf_template.render(ns=self)
+        return NAMED9_TMPL.stream(ns=self)
 
     @property
     def base_dir(self):
         if self.use_chroot:
             return ''
-        return os.path.join(os.getcwd(), 'chroots', self.name)
+        return os.path.abspath(self.chroot_dir)
 
     def build_chroot(self):
         logging.info('Building %s', self.name)
         self.build_dirs()
-        with open('chroots/%s/var/named/named9.conf' % self.name, 'w') as fh:
-            fh.write(self.render_named9_conf())
+        with open(f'{self.chroot_dir}/var/named/named9.conf', 'w',
+                  buffering=WRITE_BUFFER_SIZE) as fh:
+            self.render_named9_conf().dump(fh)
 
 
 class RecursiveNameserver(Nameserver):
-    def __init__(self, name, ip, use_chroot, root_ns_ip):
-        super(RecursiveNameserver, self).__init__(name, ip, use_chroot)
-        self.root_ns_ip = root_ns_ip
+    __slots__ = ('root_ns_ip',)
 
-    @property
-    def is_recursive(self):
-        return True
+    is_recursive = True
+
+    def __init__(self, name, ip, use_chroot, chroots_dir, root_ns_ip):
+        super().__init__(name, ip, use_chroot, chroots_dir)
+        self.root_ns_ip = root_ns_ip
 
     def build_chroot(self):
-        super(RecursiveNameserver, self).build_chroot()
-        db_cache = ENV.get_template('db.cache')
-        with open('chroots/%s/var/named/zones/db.cache'
-                  % self.name, 'w') as fh:
-            fh.write(db_cache.render(root_ns_ip=self.root_ns_ip))
+        super().build_chroot()
+        with open(f'{self.chroot_dir}/var/named/zones/db.cache',
+                  'w') as fh:
+            DB_CACHE_TMPL.stream(root_ns_ip=self.root_ns_ip).dump(fh)
 
 
 class AuthNameserver(Nameserver):
-    def __init__(self, name, ip, use_chroot):
-        super(AuthNameserver, self).__init__(name, ip, use_chroot)
+    __slots__ = ('zones', 'delegated_zones')
+
+    is_recursive = False
+
+    def __init__(self, name, ip, use_chroot, chroots_dir):
+        super().__init__(name, ip, use_chroot, chroots_dir)
         self.zones = []
         self.delegated_zones = []
 
-    @property
-    def is_recursive(self):
-        return False
-
     def build_chroot(self):
-        super(AuthNameserver, self).build_chroot()
+        super().build_chroot()
+        zones_dir = f'{self.chroot_dir}/var/named/zones/'
         for zone in self.zones:
-            zone.write_zonefile(self.name)
+            zone.write_zonefile(zones_dir)
+
 
+class MasterZone:
+    __slots__ = ('name', 'auth_nameservers', 'refresh', 'retry', 'expire',
+                 'negative_ttl', 'test_records')
+
+    type = 'master'
+    is_slave = False
+    template = ZONE_TMPL
+    _test_records_cache = {}
 
-class MasterZone(object):
     def __init__(self, name, auth_nameservers,
                  refresh, retry, expire, negative_ttl,
                  record_count):
@@ -82,131 +124,262 @@ class MasterZone(object):
         self.retry = retry
         self.expire = expire
         self.negative_ttl = negative_ttl
-        self.test_records = ['test%d' % i for i in xrange(record_count)]
+        self.test_records = self.shared_test_records(record_count)
 
-    @property
-    def type(self):
-        return 'master'
+    @staticmethod
+    def shared_test_records(record_count):
+        # The records are relative to the zone's $ORIGIN and therefore
+        # identical for every zone, so they are rendered once per count.
+        records = MasterZone._test_records_cache.get(record_count)
+        if records is None:
+            records = ''.join(f'test{i} TXT 1\n' for i in range(record_count))
+            MasterZone._test_records_cache[record_count] = records
+        return records
 
-    @property
-    def is_slave(self):
-        return False
-
-    @property
-    def template_file(self):
-        return 'zone_template'
-
-    def write_zonefile(self, ns_name):
-        zone_template = ENV.get_template(self.template_file)
-        file_path = 'chroots/%s/var/named/zones/%s.zone' % (ns_name, self.name)
-        with open(file_path, 'w') as fh:
-            fh.write(zone_template.render(zone=self))
+    def write_zonefile(self, zones_dir):
+        with open(zones_dir + self.name + '.zone', 'w',
+                  buffering=WRITE_BUFFER_SIZE) as fh:
+            self.template.stream(zone=self).dump(fh)
 
 
 class RootZone(MasterZone):
+    __slots__ = ('root_ns',)
+
+    template = ROOT_ZONE_TMPL
 
     def __init__(self, root_ns):
         self.root_ns = root_ns
         self.name = '.'
 
-    @property
-    def template_file(self):
-        return 'root_zone_template'
 
+class SlaveZone:
+    __slots__ = ('name', 'master_ips')
+
+    type = 'slave'
+    is_slave = True
 
-class SlaveZone(object):
     def __init__(self, name, master_ips):
         self.name = name
         self.master_ips = master_ips
 
-    @property
-    def type(self):
-        return 'slave'
-
-    @property
-    def is_slave(self):
-        return True
-
-    def write_zonefile(self, ns_name):
+    def write_zonefile(self, zones_dir):
         pass
 
 
 class StubZone(SlaveZone):
-    @property
-    def type(self):
-        return 'stub'
+    __slots__ = ()
+
+    type = 'stub'
+
+
+def start_command(command, pipe_stdin=False):
+    logging.debug('Running command: %s', ' '.join(command))
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    # Unless the output is going to be logged, only stderr is read back,
+    # for the error message.
+    return subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if pipe_stdin else subprocess.DEVNULL,
+        stdout=subprocess.PIPE if debug else subprocess.DEVNULL,
+        stderr=subprocess.STDOUT if debug else subprocess.PIPE,
+        text=True
+    )
 
 
-def run_command(command, stop_on_failure=True):
-    logging.debug('Running command: %s', command)
-    command = command.split()
-    try:
-        output = subprocess.check_output(
-            command,
-            stderr=subprocess.STDOUT
-        )
-    except subprocess.CalledProcessError as e:
-        logging.error(e.output)
+def finish_command(process, stop_on_failure=True, input=None):
+    output, errors = process.communicate(input)
+    if output is None:
+        output = errors
+    if process.returncode:
+        logging.error(output)
         if stop_on_failure:
-            raise
-    else:
-        if output:
-            logging.debug('Command output: %s', output)
+            raise subprocess.CalledProcessError(
+                process.returncode, process.args, output)
+    elif output:
+        logging.debug('Command output: %s', output)
+
+
+def run_command(command, stop_on_failure=True, input=None):
+    process = start_command(command, pipe_stdin=input is not None)
+    finish_command(process, stop_on_failure, input)
 
 
+def parallel_map(func, items):
+    if not items:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(MAX_WORKERS, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+@functools.lru_cache(maxsize=None)
 def ns_ips(ns_ip_prefix, ns_count):
-    return ['%s.%d' % (ns_ip_prefix, i + 1) for i in xrange(ns_count)]
+    return tuple(f'{ns_ip_prefix}.{i + 1}' for i in range(ns_count))
+
+
+def remove_old_chroots(path):
+    failures = []
+
+    def record_failure(func, failed_path, exc_info):
+        failures.append((failed_path, exc_info[1]))
 
+    shutil.rmtree(path, onerror=record_failure)
+    if failures:
+        failed_path, error = failures[0]
+        logging.warning('Could not fully remove %s, delete it by hand '
+                        '(%d failures, first: %s: %s)',
+                        path, len(failures), failed_path, error)
 
-def clean_existing_directories():
+
+def clean_existing_directories(chroots_dir):
     logging.info('Removing existing chroots')
-    if os.path.exists('chroots'):
-        shutil.rmtree('chroots')
+    if not os.path.lexists(chroots_dir):
+        return
+    # Renaming the old tree out of the way is a single syscall; the slow
+    # recursive delete then runs alongside the new build. mkdtemp reserves
+    # an unused name, and the rename replaces that empty directory.
+    old_chroots = tempfile.mkdtemp(
+        prefix=os.path.basename(chroots_dir) + '.old.',
+        dir=os.path.dirname(chroots_dir) or os.curdir)
+    try:
+        os.rename(chroots_dir, old_chroots)
+    except OSError as e:
+        os.rmdir(old_chroots)
+        # Typically a mount point, e.g. a tmpfs: empty it but keep the
+        # directory itself, which cannot be removed either.
+        logging.warning('Cannot move %s aside (%s), emptying it in place',
+                        chroots_dir, e.strerror)
+        for entry in os.scandir(chroots_dir):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+        return
+    threading.Thread(target=remove_old_chroots, args=(old_chroots,)).start()
 
 
 def kill_running_nameservers():
-    run_command('killall named', stop_on_failure=False)
+    run_command(['killall', 'named'], stop_on_failure=False)
+
+
+def nameservers_running():
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as fh:
+                stat = fh.read()
+        except OSError:
+            # The process exited while we were looking at it.
+            continue
+        # stat is "pid (comm) state ..."; a zombie has already stopped.
+        comm, _, rest = stat.partition('(')[2].rpartition(')')
+        if comm == 'named' and rest.split()[0] != 'Z':
+            return True
+    return False
+
+
+def wait_for_nameservers_to_stop(timeout=5):
+    deadline = time.monotonic() + timeout
+    while nameservers_running():
+        if time.monotonic() >= deadline:
+            logging.warning('named still running after %ds', timeout)
+            return
+        time.sleep(0.05)
 
 
 def configure_ips(nameservers):
     logging.info('Configuring ips')
-    for i, ns in enumerate(nameservers):
-        run_command('ifconfig lo:%d %s' % (i, ns.ip))
+    # One `ip -batch` run adds every alias; `replace` keeps reruns from
+    # failing on addresses left behind by a previous run.
+    commands = ''.join(
+        f'address replace {ns.ip}/32 dev lo label lo:{i}\n'
+        for i, ns in enumerate(nameservers))
+    run_command(['ip', '-batch', '-'], input=commands)
 
 
-def start_nameservers(ns_path, use_chroots):
+def start_nameservers(ns_path, nameservers, use_chroots):
     logging.info('Starting nameservers')
-    for chroot in os.listdir('chroots'):
+    commands = []
+    for ns in nameservers:
         if use_chroots:
-            run_command(
-                '%s -t chroots/%s -c /var/named/named9.conf' % (
-                    ns_path, chroot))
+            commands.append(
+                [ns_path, '-t', ns.chroot_dir,
+                 '-c', '/var/named/named9.conf'])
         else:
-            conf_path = os.path.join(os.getcwd(), 'chroots', chroot,
-                                     'var/named/named9.conf')
-            run_command('%s -c %s' % (ns_path, conf_path))
+            conf_path = os.path.join(ns.base_dir, 'var/named/named9.conf')
+            commands.append([ns_path, '-c', conf_path])
+
+    processes = [start_command(command) for command in commands]
+    # named daemonizes, so each of these exits once its server is up.
+    # Reap every launcher before reporting the first failure.
+    failures = []
+    for process in processes:
+        try:
+            finish_command(process)
+        except subprocess.CalledProcessError as e:
+            failures.append(e)
+    if failures:
+        raise failures[0]
 
 
 def nsupdate_loop(nsupdate_path, update_interval,
                   master_ns, zones):
     current_value = 1
 
-    while True:
-        nsupdate_template = ENV.get_template('nsupdate')
-        logging.info('Updating test TXT record from %d to %d',
-                     current_value, current_value + 1)
-        for zone in zones:
-            nsupdate_statements = nsupdate_template.render(
-                master_ip=master_ns.ip,
-                old_value=current_value,
-                new_value=current_value + 1,
-                zone=zone
-            ).replace('\n\n', '\n')
-            with open('/tmp/nsupdate_statements', 'w') as fh:
-                fh.write(nsupdate_statements)
-            run_command('%s /tmp/nsupdate_statements' % nsupdate_path)
-        current_value += 1
-        time.sleep(update_interval)
+    # A single nsupdate session reads every update from stdin, each one
+    # terminated by its own 'send'. On a pipe nsupdate keeps reading
+    # after a failed update and only reports it on stderr, so stderr is
+    # logged as it arrives and any error ends the loop.
+    logging.debug('Running command: %s', nsupdate_path)
+    nsupdate = subprocess.Popen([nsupdate_path],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                text=True)
+    errors = []
+
+    def log_errors():
+        for line in nsupdate.stderr:
+            logging.error('nsupdate: %s', line.rstrip())
+            errors.append(line)
+
+    error_logger = threading.Thread(target=log_errors)
+    error_logger.start()
+    try:
+        while not errors and nsupdate.poll() is None:
+            logging.info('Updating test TXT record from %d to %d',
+                         current_value, current_value + 1)
+            try:
+                for zone in zones:
+                    nsupdate.stdin.write(NSUPDATE_TMPL.render(
+                        master_ip=master_ns.ip,
+                        old_value=current_value,
+                        new_value=current_value + 1,
+                        zone=zone
+                    ) + '\n')
+                nsupdate.stdin.flush()
+            except BrokenPipeError:
+                break
+            current_value += 1
+            time.sleep(update_interval)
+    finally:
+        try:
+            nsupdate.stdin.close()
+        except BrokenPipeError:
+            pass
+        nsupdate.wait()
+        error_logger.join()
+        if nsupdate.returncode:
+            logging.error('%s exited with status %d',
+                          nsupdate_path, nsupdate.returncode)
+    if nsupdate.returncode:
+        raise subprocess.CalledProcessError(
+            nsupdate.returncode, [nsupdate_path], stderr=''.join(errors))
+    if errors:
+        raise RuntimeError(
+            f'{nsupdate_path} reported an error: {errors[0].rstrip()}')
+    raise RuntimeError(f'{nsupdate_path} exited unexpectedly')
 
 
 def main():
@@ -238,6 +411,8 @@ def main():
     parser.add_argument('--nsupdate-interval', type=int, default=1)
 
     parser.add_argument('--no-chroots', action='store_true', default=False)
+    parser.add_argument('--chroots-dir', type=os.path.normpath,
+                        default='chroots')
     parser.add_argument('--debug', action='store_true', default=False)
 
     args = parser.parse_args()
@@ -257,68 +432,78 @@ def main():
     master_ns = AuthNameserver(
         name='master',
         ip=args.master_ip,
-        use_chroot=use_chroot)
+        use_chroot=use_chroot,
+        chroots_dir=args.chroots_dir)
+    xfr_ips = ns_ips(args.xfr_ip_prefix, args.xfr_count)
     xfrs = [
         AuthNameserver(
-            name='xfr%d' % i,
-            ip='%s.%d' % (args.xfr_ip_prefix, i + 1),
-            use_chroot=use_chroot)
-        for i in xrange(args.xfr_count)]
+            name=f'xfr{i}',
+            ip=ip,
+            use_chroot=use_chroot,
+            chroots_dir=args.chroots_dir)
+        for i, ip in enumerate(xfr_ips)]
     resolvers = [
         AuthNameserver(
-            name='resolver%d' % i,
-            ip='%s.%d' % (args.resolver_ip_prefix, i + 1),
-            use_chroot=use_chroot)
-        for i in xrange(args.resolver_count)]
-    auth_nameservers = [master_ns] + xfrs + resolvers
+            name=f'resolver{i}',
+            ip=ip,
+            use_chroot=use_chroot,
+            chroots_dir=args.chroots_dir)
+        for i, ip in enumerate(
+            ns_ips(args.resolver_ip_prefix, args.resolver_count))]
+    auth_nameservers = tuple([master_ns] + xfrs + resolvers)
 
     master_zones = [
-        MasterZone('zone%d.com' % i,
+        MasterZone(f'zone{i}.com',
                    auth_nameservers=auth_nameservers,
                    refresh=args.refresh,
                    retry=args.retry,
                    expire=args.expire,
                    negative_ttl=args.negative_ttl,
                    record_count=args.record_count)
-        for i in xrange(args.zone_count)]
+        for i in range(args.zone_count)]
     master_ns.zones = master_zones
 
+    master_ips = [master_ns.ip]
     xfr_zones = [
-        SlaveZone('zone%d.com' % i, master_ips=[master_ns.ip])
-        for i in xrange(args.zone_count)]
+        SlaveZone(f'zone{i}.com', master_ips=master_ips)
+        for i in range(args.zone_count)]
     for xfr in xfrs:
         xfr.zones = xfr_zones
 
     resolver_zones = [
-        SlaveZone('zone%d.com' % i, master_ips=[xfr.ip for xfr in xfrs])
-        for i in xrange(args.zone_count)]
+        SlaveZone(f'zone{i}.com', master_ips=xfr_ips)
+        for i in range(args.zone_count)]
     for resolver in resolvers:
         resolver.zones = resolver_zones
 
     if args.subdomain_resolver_count > 0:
+        subdomain_resolver_ips = ns_ips(args.subdomain_resolver_ip_prefix,
+                                        args.subdomain_resolver_count)
         subdomain_resolvers = [
             AuthNameserver(
-                name='sub%d' % i,
-                ip='%s.%d' % (args.subdomain_resolver_ip_prefix, i + 1),
-                use_chroot=use_chroot)
-            for i in xrange(args.subdomain_resolver_count)]
+                name=f'sub{i}',
+                ip=ip,
+                use_chroot=use_chroot,
+                chroots_dir=args.chroots_dir)
+            for i, ip in enumerate(subdomain_resolver_ips)]
 
+        subdomain_auth_nameservers = tuple(subdomain_resolvers)
         master_subdomain_zones = [
-            MasterZone('sub.zone%d.com' % i,
-                       auth_nameservers=subdomain_resolvers,
+            MasterZone(f'sub.zone{i}.com',
+                       auth_nameservers=subdomain_auth_nameservers,
                        refresh=args.refresh,
                        retry=args.retry,
                        expire=args.expire,
                        negative_ttl=args.negative_ttl,
                        record_count=args.record_count)
-            for i in xrange(args.zone_count)]
+            for i in range(args.zone_count)]
         for resolver in subdomain_resolvers:
             resolver.zones = master_subdomain_zones
 
         subdomain_stubs = [
-            StubZone('sub.zone%d.com' % i,
-                     master_ips=[ns.ip for ns in subdomain_resolvers])
-            for i in xrange(args.zone_count)]
+            StubZone(f'sub.zone{i}.com',
+                     master_ips=subdomain_resolver_ips)
+            for i in range(args.zone_count)]
 
         for resolver in resolvers:
             resolver.zones.extend(subdomain_stubs)
@@ -328,34 +513,37 @@ def main():
     root_ns = AuthNameserver(
         name='root',
         ip=args.root_ns_ip,
-        use_chroot=use_chroot)
+        use_chroot=use_chroot,
+        chroots_dir=args.chroots_dir)
 
     root_zone = RootZone(root_ns=root_ns)
     root_ns.zones = [root_zone]
-    delegated_zones = copy.deepcopy(master_zones)
+    delegated_auth_nameservers = tuple(resolvers)
+    delegated_zones = [copy.copy(z) for z in master_zones]
     for z in delegated_zones:
-        z.auth_nameservers = resolvers
+        z.auth_nameservers = delegated_auth_nameservers
     root_ns.delegated_zones = delegated_zones
 
     recursive_nameservers = [
         RecursiveNameserver(
-            name='recursive%d' % i,
-            ip='%s.%d' % (args.recursive_ns_prefix, i + 1),
+            name=f'recursive{i}',
+            ip=ip,
             use_chroot=use_chroot,
+            chroots_dir=args.chroots_dir,
             root_ns_ip=args.root_ns_ip)
-        for i in xrange(args.recursive_ns_count)]
+        for i, ip in enumerate(
+            ns_ips(args.recursive_ns_prefix, args.recursive_ns_count))]
 
-    clean_existing_directories()
+    clean_existing_directories(args.chroots_dir)
 
     all_nameservers = [root_ns, master_ns] + xfrs + resolvers + subdomain_resolvers + recursive_nameservers
-    for ns in all_nameservers:
-        ns.build_chroot()
+    parallel_map(lambda ns: ns.build_chroot(), all_nameservers)
 
     if args.ns_path is not None:
         kill_running_nameservers()
-        time.sleep(5)  # TODO: check that they actually stopped
+        wait_for_nameservers_to_stop()
         configure_ips(all_nameservers)
-        start_nameservers(args.ns_path, not args.no_chroots)
+        start_nameservers(args.ns_path, all_nameservers, not args.no_chroots)
 
     if args.nsupdate_path is not None:
         nsupdate_loop(args.nsupdate_path, args.nsupdate_interval,